@@ -19,11 +19,11 @@ The boolean flag is True if the transports are capable of sending anonymous tran
 
 def _make_transport_can(node_id_a: typing.Optional[int], node_id_b: typing.Optional[int]) -> TransportPack:
     from pyuavcan.transport.can import CANTransport
-    from tests.transport.can.media.mock import MockMedia
-    bus: typing.Set[MockMedia] = set()
+    from tests.transport.can.media.mock import MockMedia, PeerBus
+    bus = PeerBus()
     media_a = MockMedia(bus, 8, 1)
     media_b = MockMedia(bus, 64, 2)      # Heterogeneous setup
-    assert bus == {media_a, media_b}
+    assert set(bus) == {media_a, media_b}
     return CANTransport(media_a, node_id_a), CANTransport(media_b, node_id_b), True
 
 
@@ -63,11 +63,11 @@ def _make_transport_redundant_can_can_can(node_id_a: typing.Optional[int],
                                           node_id_b: typing.Optional[int]) -> TransportPack:
     from pyuavcan.transport.redundant import RedundantTransport
     from pyuavcan.transport.can import CANTransport
-    from tests.transport.can.media.mock import MockMedia
+    from tests.transport.can.media.mock import MockMedia, PeerBus
 
-    bus_0: typing.Set[MockMedia] = set()
-    bus_1: typing.Set[MockMedia] = set()
-    bus_2: typing.Set[MockMedia] = set()
+    bus_0 = PeerBus()
+    bus_1 = PeerBus()
+    bus_2 = PeerBus()
 
     def one(nid: typing.Optional[int]) -> RedundantTransport:
         # Triply redundant CAN bus.
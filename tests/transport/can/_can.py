@@ -25,15 +25,15 @@ async def _unittest_can_transport_anon() -> None:
     from pyuavcan.transport.can._identifier import MessageCANID
     # noinspection PyProtectedMember
     from pyuavcan.transport.can._frame import UAVCANFrame
-    from .media.mock import MockMedia, FrameCollector
+    from .media.mock import MockMedia, FrameCollector, PeerBus
 
     with pytest.raises(pyuavcan.transport.InvalidTransportConfigurationError):
-        can.CANTransport(MockMedia(set(), 64, 0), None)
+        can.CANTransport(MockMedia(PeerBus(), 64, 0), None)
 
     with pytest.raises(pyuavcan.transport.InvalidTransportConfigurationError):
-        can.CANTransport(MockMedia(set(), 7, 16), None)
+        can.CANTransport(MockMedia(PeerBus(), 7, 16), None)
 
-    peers: typing.Set[MockMedia] = set()
+    peers = PeerBus()
     media = MockMedia(peers, 64, 10)
     media2 = MockMedia(peers, 64, 3)
     peeper = MockMedia(peers, 64, 10)
@@ -237,9 +237,9 @@ async def _unittest_can_transport_non_anon() -> None:
     from pyuavcan.transport.can._identifier import MessageCANID, ServiceCANID
     # noinspection PyProtectedMember
     from pyuavcan.transport.can._frame import UAVCANFrame
-    from .media.mock import MockMedia, FrameCollector
+    from .media.mock import MockMedia, FrameCollector, PeerBus
 
-    peers: typing.Set[MockMedia] = set()
+    peers = PeerBus()
     media = MockMedia(peers, 64, 10)
     media2 = MockMedia(peers, 64, 3)
     peeper = MockMedia(peers, 64, 10)
@@ -5,4 +5,5 @@
 #
 
 from ._media import MockMedia as MockMedia
+from ._media import PeerBus as PeerBus
 from ._media import FrameCollector as FrameCollector
@@ -7,31 +7,89 @@
 from __future__ import annotations
 import typing
 import pytest
+import collections
 import asyncio
+import numpy
 import pyuavcan.transport
 import pyuavcan.transport.can.media as _media
 
 
+_FilterTuple = typing.Tuple[int, int, typing.Optional[_media.FrameFormat], int]
+"""
+Mask, masked reference identifier, format (None if both formats are accepted), and the index of the hit counter.
+"""
+
+
+class PeerBus(typing.MutableSet['MockMedia']):
+    """
+    The set of mock media instances connected to the same virtual bus.
+    Unlike the built-in set, iteration follows the order in which the instances have joined the bus.
+    """
+
+    def __init__(self) -> None:
+        self._list: typing.List[MockMedia] = []
+        self._set: typing.Set[MockMedia] = set()
+        self._others: typing.Dict[MockMedia, typing.Tuple[MockMedia, ...]] = {}
+
+    def add(self, value: MockMedia) -> None:
+        if value not in self._set:
+            self._list.append(value)
+            self._set.add(value)
+            self._others.clear()
+
+    def discard(self, value: MockMedia) -> None:
+        if value in self._set:
+            self._list.remove(value)
+            self._set.discard(value)
+            self._others.clear()
+
+    def others(self, member: MockMedia) -> typing.Tuple[MockMedia, ...]:
+        """
+        All members except the specified one in the order of joining; this is the set of broadcast recipients.
+        The result is cached until the membership changes.
+        """
+        try:
+            return self._others[member]
+        except KeyError:
+            out = self._others[member] = tuple(p for p in self._list if p is not member)
+            return out
+
+    def __contains__(self, x: object) -> bool:
+        return x in self._set
+
+    def __iter__(self) -> typing.Iterator[MockMedia]:
+        return iter(self._list)
+
+    def __len__(self) -> int:
+        return len(self._list)
+
+    def __repr__(self) -> str:  # pragma: no cover
+        return f'{type(self).__name__}({self._list})'
+
+
 class MockMedia(_media.Media):
-    def __init__(self, peers: typing.Set[MockMedia], mtu: int, number_of_acceptance_filters: int):
+    def __init__(self, peers: PeerBus, mtu: int, number_of_acceptance_filters: int):
         self._peers = peers
         peers.add(self)
 
         self._mtu = int(mtu)
 
         self._rx_handler: _media.Media.ReceivedFramesHandler = lambda _: None  # pragma: no cover
-        self._acceptance_filters = [self._make_dead_filter()  # By default drop (almost) all frames
-                                    for _ in range(int(number_of_acceptance_filters))]
+        self._acceptance_filters: typing.List[_media.FilterConfiguration] = []
+        self._set_acceptance_filters([self._make_dead_filter()  # By default drop (almost) all frames
+                                      for _ in range(int(number_of_acceptance_filters))])
         self._automatic_retransmission_enabled = False      # This is the default per the media interface spec
         self._closed = False
 
         self._raise_on_send_once: typing.Optional[Exception] = None
 
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None     # Bound when started
+
         super(MockMedia, self).__init__()
 
     @property
     def loop(self) -> asyncio.AbstractEventLoop:
-        return asyncio.get_event_loop()
+        return self._loop or asyncio.get_event_loop()
 
     @property
     def interface_name(self) -> str:
@@ -51,6 +109,7 @@ class MockMedia(_media.Media):
 
         assert callable(handler)
         self._rx_handler = handler
+        self._loop = asyncio.get_event_loop()
         assert isinstance(no_automatic_retransmission, bool)
         self._automatic_retransmission_enabled = not no_automatic_retransmission
 
@@ -63,7 +122,32 @@ class MockMedia(_media.Media):
             configuration.append(self._make_dead_filter())
 
         assert len(configuration) == len(self._acceptance_filters)
+        self._set_acceptance_filters(configuration)
+
+    def _set_acceptance_filters(self, configuration: typing.List[_media.FilterConfiguration]) -> None:
         self._acceptance_filters = configuration
+        # The masked reference identifier is precomputed for the per-frame test; see _test_acceptance().
+        self._filter_tuples: typing.List[_FilterTuple] = [
+            (f.mask, f.identifier & f.mask, f.format, index) for index, f in enumerate(configuration)
+        ]
+        self._filter_hits: typing.List[int] = [0] * len(self._filter_tuples)
+        self._frames_tested: int = 0
+        # The filters are also stored as a structure of arrays for vectorized matching; see _select_accepted().
+        # The masks and the masked identifiers share one contiguous buffer: row 0 holds the masks, row 1 holds
+        # the masked identifiers; each row is a contiguous view. Negative format means that both formats are accepted.
+        self._filter_packed: numpy.ndarray = numpy.array([[m for m, _, _, _ in self._filter_tuples],
+                                                          [i for _, i, _, _ in self._filter_tuples]],
+                                                         dtype=numpy.uint32)
+        self._mask_arr: numpy.ndarray = self._filter_packed[0]
+        self._id_masked_arr: numpy.ndarray = self._filter_packed[1]
+        self._fmt_arr: numpy.ndarray = numpy.fromiter((-1 if f.format is None else int(f.format)
+                                                       for f in configuration),
+                                                      dtype=numpy.int8)
+        # A promiscuous filter makes the others irrelevant. The dead filter is not a reject-all filter
+        # (it still accepts the base frame with zero CAN ID), so nothing is rejected unconditionally
+        # unless there are no filters at all.
+        self._accept_all: bool = any(f.mask == 0 and f.format is None for f in configuration)
+        self._reject_all: bool = len(configuration) == 0
 
     @property
     def automatic_retransmission_enabled(self) -> bool:
@@ -88,24 +172,32 @@ class MockMedia(_media.Media):
         timestamp = pyuavcan.transport.Timestamp.now()
 
         # Broadcast across the virtual bus we're emulating here.
-        for p in self._peers:
-            if p is not self:
-                # Unconditionally clear the loopback flag because for the other side these are
-                # regular received frames, not loopback frames.
-                p._receive(_media.TimestampedDataFrame(identifier=f.identifier,
-                                                       data=f.data,
-                                                       format=f.format,
-                                                       loopback=False,
-                                                       timestamp=timestamp)
-                           for f in frames)
-
-        # Simple loopback emulation with acceptance filtering.
-        self._receive(_media.TimestampedDataFrame(identifier=f.identifier,
-                                                  data=f.data,
-                                                  format=f.format,
-                                                  loopback=True,
-                                                  timestamp=timestamp)
-                      for f in frames if f.loopback)
+        # Unconditionally clear the loopback flag because for the other side these are
+        # regular received frames, not loopback frames. The frames are immutable so they are shared by all peers.
+        # The payload is not copied: the same buffer is referenced by the original frame and all its received copies.
+        # The acceptance filters of the peers are applied to the transmitted frames before the received frames are
+        # constructed, so that the frames nobody accepts are never constructed at all.
+        tdf = _media.TimestampedDataFrame   # Bound locally to avoid the global and attribute lookups in the loop.
+        rx_frames: typing.List[typing.Optional[_media.TimestampedDataFrame]] = [None] * len(frames)
+        match_arrays: typing.Optional[typing.Tuple[numpy.ndarray, numpy.ndarray]] = None   # Built once if needed
+        for p in self._peers.others(self):
+            if p._uses_vectorized_matching(len(frames)):
+                if match_arrays is None:
+                    match_arrays = _make_match_arrays(frames)
+                accepted = p._select_accepted_vectorized(*match_arrays)
+            else:
+                accepted = p._select_accepted(frames)
+            if accepted:
+                for i in accepted:
+                    if rx_frames[i] is None:
+                        f = frames[i]
+                        rx_frames[i] = tdf(f.identifier, f.data, f.format, False, timestamp)
+                p._receive_prefiltered([typing.cast(_media.TimestampedDataFrame, rx_frames[i]) for i in accepted])
+
+        # Simple loopback emulation with acceptance filtering. Most transmissions do not request loopback.
+        loopback_frames = [tdf(f.identifier, f.data, f.format, True, timestamp) for f in frames if f.loopback]
+        if loopback_frames:
+            self._receive(loopback_frames)
 
         return len(frames)
 
@@ -121,23 +213,71 @@ class MockMedia(_media.Media):
 
     def inject_received(self, frames: typing.Iterable[_media.DataFrame]) -> None:
         timestamp = pyuavcan.transport.Timestamp.now()
-        self._receive(_media.TimestampedDataFrame(identifier=f.identifier,
-                                                  data=f.data,
-                                                  format=f.format,
-                                                  loopback=f.loopback,
-                                                  timestamp=timestamp)
-                      for f in frames)
+        tdf = _media.TimestampedDataFrame
+        self._receive([tdf(f.identifier, f.data, f.format, f.loopback, timestamp) for f in frames])
+
+    def _receive_prefiltered(self, frames: typing.List[_media.TimestampedDataFrame]) -> None:
+        """
+        The frames shall be already accepted by the acceptance filters; see :meth:`_select_accepted`.
+        """
+        self._rx_handler(frames)
 
     def _receive(self, frames: typing.Iterable[_media.TimestampedDataFrame]) -> None:
-        frames = list(filter(self._test_acceptance, frames))
+        if self._reject_all:
+            return
+        # The batch is handed over as-is if there is nothing to filter; only one-shot iterables need to be copied.
+        frames = frames if isinstance(frames, list) else list(frames)
+        if not self._accept_all:
+            frames = [frames[i] for i in self._select_accepted(frames)]
         if frames:                                          # Where are the assignment expressions when you need them?
             self._rx_handler(frames)
 
+    def _select_accepted(self, frames: typing.Sequence[_media.DataFrame]) -> typing.List[int]:
+        """
+        Returns the indexes of the frames that pass the acceptance filters, in the original order.
+        """
+        if self._reject_all:
+            return []
+        if self._accept_all:
+            return list(range(len(frames)))
+        if not self._uses_vectorized_matching(len(frames)):
+            # The filter order is updated once per batch rather than per frame to keep the per-frame test cheap.
+            self._frames_tested += len(frames)
+            if self._frames_tested >= _FILTER_REORDER_INTERVAL:
+                self._frames_tested = 0
+                self._reorder_filters()
+            return [i for i, f in enumerate(frames) if self._test_acceptance(f)]
+        return self._select_accepted_vectorized(*_make_match_arrays(frames))
+
+    def _uses_vectorized_matching(self, number_of_frames: int) -> bool:
+        return not self._reject_all and not self._accept_all \
+            and number_of_frames * len(self._filter_tuples) >= _VECTORIZATION_THRESHOLD
+
+    def _select_accepted_vectorized(self, idents: numpy.ndarray, fmts: numpy.ndarray) -> typing.List[int]:
+        """
+        Like :meth:`_select_accepted` but the frames are given as arrays; see :func:`_make_match_arrays`.
+        This allows the sender to build the arrays once for all peers.
+        """
+        accept = _match(idents, fmts, self._mask_arr, self._id_masked_arr, self._fmt_arr)
+        return typing.cast(typing.List[int], numpy.flatnonzero(accept).tolist())
+
     def _test_acceptance(self, frame: _media.DataFrame) -> bool:
-        return any(map(
-            lambda f:
-            frame.identifier & f.mask == f.identifier & f.mask and (f.format is None or frame.format == f.format),
-            self._acceptance_filters))
+        if self._accept_all:
+            return True
+        for mask, id_masked, fmt, hit_index in self._filter_tuples:
+            if ((frame.identifier ^ id_masked) & mask) == 0 and (fmt is None or frame.format == fmt):
+                self._filter_hits[hit_index] += 1
+                return True
+        return False
+
+    def _reorder_filters(self) -> None:
+        """
+        Moves the most frequently matching filters to the front so that the per-frame test terminates sooner.
+        The hit counters are halved afterwards so that the order follows changes in the traffic pattern.
+        """
+        hits = self._filter_hits
+        self._filter_tuples.sort(key=lambda x: -hits[x[3]])
+        self._filter_hits = [x // 2 for x in hits]
 
     @staticmethod
     def list_available_interface_names() -> typing.Iterable[str]:
@@ -149,12 +289,50 @@ class MockMedia(_media.Media):
         return _media.FilterConfiguration(0, 2 ** int(fmt) - 1, fmt)
 
 
+def _make_match_arrays(frames: typing.Sequence[_media.DataFrame]) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Returns the identifiers and the formats of the frames as arrays suitable for :func:`_match`.
+    """
+    idents = numpy.fromiter((f.identifier for f in frames), dtype=numpy.uint32, count=len(frames))
+    fmts = numpy.fromiter((int(f.format) for f in frames), dtype=numpy.int8, count=len(frames))
+    return idents, fmts
+
+
+def _match(idents: numpy.ndarray,
+           fmts: numpy.ndarray,
+           masks: numpy.ndarray,
+           ids_masked: numpy.ndarray,
+           filter_fmts: numpy.ndarray) -> numpy.ndarray:
+    """
+    Matches a batch of frames against all filters at once: rows are frames, columns are filters.
+    Returns a boolean array with one element per frame which is True if the frame is accepted by any filter.
+    Negative filter format means that both formats are accepted.
+    """
+    accept: numpy.ndarray = (((((idents[:, None] ^ ids_masked[None, :]) & masks[None, :]) == 0)
+                              & ((filter_fmts[None, :] < 0) | (filter_fmts[None, :] == fmts[:, None])))
+                             .any(axis=1))
+    return accept
+
+
+_VECTORIZATION_THRESHOLD = 256
+"""
+Vectorized matching has a fixed setup cost of a few tens of microseconds, which is only worth paying
+if the number of frame-filter pairs to check is large. Below that the plain per-frame loop is faster.
+"""
+
+
+_FILTER_REORDER_INTERVAL = 1024
+"""
+The filters are reordered by their hit rate after approximately this many frames have been tested one by one.
+"""
+
+
 @pytest.mark.asyncio    # type: ignore
 async def _unittest_can_mock_media() -> None:
     import asyncio
     from pyuavcan.transport.can.media import DataFrame, FrameFormat, FilterConfiguration
 
-    peers: typing.Set[MockMedia] = set()
+    peers = PeerBus()
 
     me = MockMedia(peers, 64, 3)
     assert len(peers) == 1 and me in peers
@@ -185,7 +363,9 @@ async def _unittest_can_mock_media() -> None:
     assert me_collector.empty
 
     pe = MockMedia(peers, 8, 1)
-    assert peers == {me, pe}
+    assert set(peers) == {me, pe}
+    assert list(peers) == [me, pe]        # The order of joining is preserved
+    assert peers.others(me) == (pe,) and peers.others(pe) == (me,)
 
     pe_collector = FrameCollector()
     pe.start(pe_collector.give, False)
@@ -201,21 +381,102 @@ async def _unittest_can_mock_media() -> None:
     assert pe_collector.empty
 
     pe.configure_acceptance_filters([FilterConfiguration(123, 127, None)])
+    payload = bytearray(b'def')
     await me.send_until([
         DataFrame(123, bytearray(b'abc'), FrameFormat.EXTENDED, loopback=False),
-        DataFrame(123, bytearray(b'def'), FrameFormat.EXTENDED, loopback=True),
+        DataFrame(123, payload, FrameFormat.EXTENDED, loopback=True),
     ], asyncio.get_event_loop().time() + 1.0)
     await me.send_until([
         DataFrame(456, bytearray(b'ghi'), FrameFormat.EXTENDED, loopback=False),    # Dropped by the filters
     ], asyncio.get_event_loop().time() + 1.0)
     assert pe_collector.pop().is_same_manifestation(
         DataFrame(123, bytearray(b'abc'), FrameFormat.EXTENDED, loopback=False))
-    assert pe_collector.pop().is_same_manifestation(
-        DataFrame(123, bytearray(b'def'), FrameFormat.EXTENDED, loopback=False))
+    received = pe_collector.pop()
+    assert received.is_same_manifestation(DataFrame(123, bytearray(b'def'), FrameFormat.EXTENDED, loopback=False))
+    assert received.data is payload     # The payload is shared, not copied.
     assert pe_collector.empty
 
+    # Both the per-frame and the vectorized matching paths are checked against the reference acceptance criteria.
+    def reference_acceptance(frame: DataFrame, filters: typing.Iterable[FilterConfiguration]) -> bool:
+        return any((frame.identifier & f.mask) == (f.identifier & f.mask)
+                   and (f.format is None or f.format == frame.format)
+                   for f in filters)
+
+    vm = MockMedia(PeerBus(), 8, 16)
+    vm_collector = FrameCollector()
+    vm.start(vm_collector.give, False)
+    vm_filters = [FilterConfiguration(0b0100, 0b0110, FrameFormat.EXTENDED),
+                  FilterConfiguration(0b1000, 0b1100, None)]
+    vm.configure_acceptance_filters(vm_filters)
+    vm_filters += [MockMedia._make_dead_filter()] * (vm.number_of_acceptance_filters - len(vm_filters))
+    candidates = [DataFrame(i, bytearray(b'x'), fmt, loopback=False) for i in range(32) for fmt in FrameFormat]
+    expected = [c for c in candidates if reference_acceptance(c, vm_filters)]
+    assert 0 < len(expected) < len(candidates)
+    # One by one -- the per-frame test is used.
+    for c in candidates:
+        vm.inject_received([c])
+    for ref in expected:
+        assert vm_collector.pop().is_same_manifestation(ref)
+    assert vm_collector.empty
+    # All at once -- the vectorized test is used.
+    assert len(candidates) * vm.number_of_acceptance_filters >= _VECTORIZATION_THRESHOLD
+    assert vm._filter_packed.flags.c_contiguous and vm._mask_arr.flags.c_contiguous
+    vm.inject_received(candidates)
+    for ref in expected:
+        assert vm_collector.pop().is_same_manifestation(ref)
+    assert vm_collector.empty
+
+    # Transmitted frames are matched against the filters of every peer that takes the vectorized path.
+    vb = PeerBus()
+    vb_tx = MockMedia(vb, 8, 1)
+    vb_rx = [MockMedia(vb, 8, 16) for _ in range(2)]
+    vb_collectors = [FrameCollector() for _ in vb_rx]
+    for m, c in zip(vb_rx, vb_collectors):
+        m.start(c.give, False)
+        m.configure_acceptance_filters(vm_filters[:2])
+    vb_rx[1].configure_acceptance_filters([FilterConfiguration(0, 0b1111, FrameFormat.EXTENDED)])
+    burst = [DataFrame(0b0100, bytearray([i + 1]), FrameFormat.EXTENDED, loopback=False) for i in range(16)]
+    assert all(m._uses_vectorized_matching(len(burst)) for m in vb_rx)
+    await vb_tx.send_until(burst, asyncio.get_event_loop().time() + 1.0)
+    for ref in burst:
+        assert vb_collectors[0].pop().is_same_manifestation(ref)
+    assert vb_collectors[0].empty
+    assert vb_collectors[1].empty      # Rejected by the filters
+
+    # The filter that matches most often is moved to the front.
+    ro = MockMedia(PeerBus(), 8, 3)
+    ro.start(lambda _: None, False)
+    ro.configure_acceptance_filters([FilterConfiguration(0b0100, 0b0110, FrameFormat.EXTENDED),
+                                     FilterConfiguration(0b1000, 0b1100, None)])
+    assert ro._filter_tuples[0][:3] == (0b0110, 0b0100, FrameFormat.EXTENDED)
+    for _ in range(_FILTER_REORDER_INTERVAL - 1):
+        ro.inject_received([DataFrame(0b1000, bytearray(b'x'), FrameFormat.BASE, loopback=False)])
+    assert ro._filter_tuples[0][:3] == (0b0110, 0b0100, FrameFormat.EXTENDED)  # Not reordered yet
+    ro.inject_received([DataFrame(0b1000, bytearray(b'x'), FrameFormat.BASE, loopback=False)])
+    assert ro._filter_tuples[0][:3] == (0b1100, 0b1000, None)
+    # The counters are halved before the last frame is tested, which then hits once more.
+    assert ro._filter_hits == [0, (_FILTER_REORDER_INTERVAL - 1) // 2 + 1, 0]
+
+    # No acceptance filters means that all frames are dropped.
+    nf = MockMedia(PeerBus(), 8, 0)
+    nf_collector = FrameCollector()
+    nf.start(nf_collector.give, False)
+    nf.configure_acceptance_filters([])
+    nf.inject_received([DataFrame(0, bytearray(b'abc'), FrameFormat.BASE, loopback=False)])
+    assert nf_collector.empty
+
+    # Errors in the receiving peer propagate to the sender.
+    def bad_handler(_: typing.Iterable[_media.TimestampedDataFrame]) -> None:
+        raise RuntimeError('Goodbye world!')
+
+    pe.start(bad_handler, False)
+    with pytest.raises(RuntimeError, match='Goodbye world!'):
+        await me.send_until([DataFrame(123, bytearray(b'abc'), FrameFormat.EXTENDED, loopback=False)],
+                            asyncio.get_event_loop().time() + 1.0)
+    pe.start(pe_collector.give, False)
+
     me.close()
-    assert peers == {pe}
+    assert set(peers) == {pe}
     with pytest.raises(pyuavcan.transport.ResourceClosedError):
         await me.send_until([], asyncio.get_event_loop().time() + 1.0)
     with pytest.raises(pyuavcan.transport.ResourceClosedError):
@@ -226,20 +487,20 @@ async def _unittest_can_mock_media() -> None:
 
 class FrameCollector:
     def __init__(self) -> None:
-        self._collected: typing.List[_media.TimestampedDataFrame] = []
+        self._collected: typing.Deque[_media.TimestampedDataFrame] = collections.deque()
 
     def give(self, frames: typing.Iterable[_media.TimestampedDataFrame]) -> None:
-        frames = list(frames)
-        assert all(map(lambda x: isinstance(x, _media.TimestampedDataFrame), frames))
-        self._collected += frames
+        if __debug__:   # The check needs a second pass over the frames, so they are materialized only if it is enabled.
+            frames = list(frames)
+            assert all(isinstance(x, _media.TimestampedDataFrame) for x in frames)
+        self._collected.extend(frames)
 
     def pop(self) -> _media.TimestampedDataFrame:
-        head, self._collected = self._collected[0], self._collected[1:]
-        return head
+        return self._collected.popleft()
 
     @property
     def empty(self) -> bool:
-        return len(self._collected) == 0
+        return not self._collected
 
     def __repr__(self) -> str:  # pragma: no cover
-        return f'{type(self).__name__}({str(self._collected)})'
+        return f'{type(self).__name__}({str(list(self._collected))})'